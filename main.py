@@ -1,33 +1,43 @@
-import platform
 import os
 from pathlib import Path
 import random
 import re
-import json
+from dataclasses import dataclass
 import sys
+import shutil
 import subprocess
 import asyncio
+import functools
 import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import logging
-from typing import Tuple
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
+from typing import List, Tuple
 import datetime
 import argparse
+import importlib.util
+
+# NumPy
+import numpy as np
 
 # PyTorch
 import torch
 
+# Fast JSON parser
+import orjson
+
 # ENV
 from dotenv import load_dotenv, find_dotenv
 
-# OpenAI Whisper Model PyTorch
-import whisper
+# Faster-Whisper Model (CTranslate2)
+from faster_whisper import BatchedInferencePipeline, WhisperModel
+from faster_whisper.vad import VadOptions, get_speech_timestamps, merge_segments
 
 # MicrosoftEdge TTS
 import edge_tts
 
-# FFMPEG (Python)
-import ffmpeg
-
 # utils.py
 from utils import *
 
@@ -35,30 +45,81 @@ from utils import *
 import msg
 
 # Default directory
-HOME = os.getcwd()
-
-# Logging
-if not os.path.isdir('log'):
-    os.mkdir('log')
-
-with KeepDir() as keep_dir:
-    keep_dir.chdir("log")
-    log_filename = f'{datetime.date.today()}.log'
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(log_filename),
-        ]
-    )
-    logger = logging.getLogger(__name__)
+HOME = Path.cwd()
+
+# Logging: records are queued and written to the log file by a background thread,
+# so that logging never blocks the event loop on disk I/O
+(HOME / 'log').mkdir(exist_ok=True)
+log_filename = HOME / 'log' / f'{datetime.date.today()}.log'
+log_handler = logging.FileHandler(log_filename)
+log_handler.setFormatter(logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[
+        QueueHandler(log_queue),
+    ]
+)
+logger = logging.getLogger(__name__)
 
 
 ###########################
 #        VIDEO.JSON       #
 ###########################
 
-jsonData = json.load(open('video.json', encoding='utf-8'))
+@dataclass(frozen=True)
+class Video:
+    """
+    A video entry of video.json.
+    """
+    series: str
+    part: int
+    outro: str
+    path: str
+    text: str
+
+
+def load_videos(filename: str = 'video.json') -> List[Video]:
+    """
+    Load and validate the videos to create.
+
+    Args:
+        filename (str, optional): The JSON file listing the videos. Defaults to 'video.json'.
+
+    Returns:
+        List[Video]: The videos, in file order.
+
+    Raises:
+        ValueError: If the file is not valid JSON or an entry has a field of the wrong type.
+        KeyError: If an entry is missing a field.
+    """
+    with open(filename, 'rb') as f:
+        data = orjson.loads(f.read())
+    videos = []
+    for i, video in enumerate(data):
+        for field in ('series', 'outro', 'path', 'text'):
+            if not isinstance(video[field], str):
+                raise ValueError(f"video {i}: '{field}' must be a string, got {video[field]!r}")
+        part = video['part']
+        if isinstance(part, str) and part.isdecimal():
+            part = int(part)
+        elif isinstance(part, bool) or not isinstance(part, int):
+            raise ValueError(f"video {i}: 'part' must be an integer, got {part!r}")
+        videos.append(Video(series=video['series'], part=part, outro=video['outro'],
+                            path=video['path'], text=video['text']))
+    return videos
+
+
+try:
+    videos = load_videos()
+except (ValueError, KeyError, TypeError) as e:
+    console.log(f"{msg.ERROR}Invalid video.json: {e!r}")
+    logger.exception(e)
+    sys.exit(1)
 
 
 #######################
@@ -70,6 +131,8 @@ async def main() -> bool:
     parser = argparse.ArgumentParser()
     parser.add_argument("--model", default="small", help="Model to use",
                         choices=["tiny", "base", "small", "medium", "large"], type=str)
+    parser.add_argument("--backend", default="faster-whisper", help="Whisper inference backend, trt requires whisper_trt and a CUDA GPU and only times subtitles approximately, hf requires transformers and times subtitles per segment (not per word) when flash-attn is installed",
+                        choices=["faster-whisper", "trt", "hf"], type=str)
     parser.add_argument("--non_english", action='store_true',
                         help="Don't use the english model.")
     parser.add_argument("--url", metavar='U', default="https://www.youtube.com/watch?v=intRX7BRA90",
@@ -96,7 +159,7 @@ async def main() -> bool:
             sys.exit(1)
 
         else: # Check if language is valid
-            voices = await edge_tts.VoicesManager.create()
+            voices = await get_voices()
             voices = voices.find(Gender=args.gender, Locale=args.language)
             if len(voices) == 0:
                 # Locale not found
@@ -128,57 +191,123 @@ async def main() -> bool:
                 f"{msg.WARNING}PyTorch GPU not found, using CPU instead")
             logger.warning('PyTorch GPU not found')
 
-        download_video(url=args.url)
+        encoder = get_encoder()
+        console.log(f"{msg.OK}Using {encoder} video encoder")
+        logger.info(f'Using {encoder} video encoder')
 
-        # OpenAI-Whisper Model
+        # Whisper Model
         model = args.model
         if args.model != "large" and not args.non_english:
             model = args.model + ".en"
-        whisper_model = whisper.load_model(model)
 
-        console.log(f"{msg.OK}OpenAI-Whisper model loaded")
-        logger.info('OpenAI-Whisper model loaded')
-
-        # Text 2 Speech (Edge TTS API)
-        for video_id, video in enumerate(jsonData):
-            series = video['series']
-            part = video['part']
-            outro = video['outro']
-            path = video['path']
-            text = video['text']
+        # Checked here, as a failure in the transcription worker only shows up as a broken process pool
+        if args.backend == "trt":
+            if not torch.cuda.is_available():
+                console.log(f"{msg.ERROR}The trt backend requires a CUDA GPU.")
+                sys.exit(1)
+            if model not in TRT_MODELS:
+                console.log(
+                    f"{msg.ERROR}The trt backend only supports the English tiny, base and small models, not {model}.")
+                sys.exit(1)
+            if importlib.util.find_spec("whisper_trt") is None:
+                console.log(f"{msg.ERROR}The trt backend requires whisper_trt: https://github.com/NVIDIA-AI-IOT/whisper_trt")
+                sys.exit(1)
+        elif args.backend == "hf" and importlib.util.find_spec("transformers") is None:
+            console.log(f"{msg.ERROR}The hf backend requires transformers: pip install transformers")
+            sys.exit(1)
 
-            req_text, filename = create_full_text(
-                path, series, part, text, outro)
+        download_video(url=args.url)
 
-            console.log(f"{msg.OK}Text converted successfully")
-            logger.info('Text converted successfully')
-            console.log(req_text)
-            await tts(req_text, outfile=filename, voice=args.tts, random_voice=args.random_voice, args=args)
+        # Whisper runs in a single worker process, spawned rather than forked so that
+        # it gets its own CUDA context, up to two ffmpeg encodes run alongside it
+        transcriber = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+                                          initializer=init_transcriber, initargs=(model, args.backend))
+        try:
+            await asyncio.get_running_loop().run_in_executor(transcriber, transcriber_ready)
 
-            console.log(
-                f"{msg.OK}Text2Speech mp3 file generated successfully!")
-            logger.info('Text2Speech mp3 file generated successfully!')
+            console.log(f"{msg.OK}Whisper model loaded ({args.backend})")
+            logger.info(f'Whisper model loaded ({args.backend})')
 
-            # Whisper Model to create SRT file from Speech recording
-            srt_filename = srt_create(
-                whisper_model, path, series, part, text, filename)
+            # Text to speech for all videos at once, then a single batched transcription of all
+            # the clips, so that the model decodes them together instead of one after the other
+            speech = await asyncio.gather(*[speak(video, args) for video in videos])
+            srt_filenames = await asyncio.get_running_loop().run_in_executor(
+                transcriber, transcribe_srts, [(video.path, video.series, video.part, video.text, audio)
+                                               for video, (_, audio) in zip(videos, speech)])
 
             console.log(
-                f"{msg.OK}Transcription srt and ass file saved successfully!")
-            logger.info('Transcription srt and ass file saved successfully!')
-
-            # Background video with srt and duration
-            background_mp4 = random_background()
-            file_info = get_info(background_mp4, verbose=args.verbose)
-            final_video = prepare_background(
-                background_mp4, filename_mp3=filename, filename_srt=srt_filename, duration=int(file_info.get('duration')), verbose=args.verbose)
-            console.log(
-                f"{msg.OK}MP4 video saved successfully!\nPath: {final_video}")
-            logger.info(f'MP4 video saved successfully!\nPath: {final_video}')
+                f"{msg.OK}Transcription srt files saved successfully!")
+            logger.info('Transcription srt files saved successfully!')
+
+            backgrounds = asyncio.Lock()
+            encoders = asyncio.Semaphore(2)
+            await asyncio.gather(*[process_video(mp3, audio, srt_filename, args, backgrounds, encoders)
+                                   for (mp3, audio), srt_filename in zip(speech, srt_filenames)])
+        except BaseException:
+            # Shutting down with wait=True, as the with statement does, would block the event loop
+            # until the worker has finished its queued work, and only then report the error
+            transcriber.shutdown(wait=False, cancel_futures=True)
+            raise
+        transcriber.shutdown()
 
     console.log(f'{msg.DONE}')
     return True
 
+async def speak(video: Video, args) -> Tuple[bytes, np.ndarray]:
+    """
+    Convert the text of a video to speech, kept in memory instead of an mp3 file.
+
+    Args:
+        video (Video): The video entry from video.json.
+        args (argparse.Namespace): The command-line arguments.
+
+    Returns:
+        Tuple[bytes, np.ndarray]: The mp3 audio and its 16kHz samples.
+    """
+    # Text 2 Speech (Edge TTS API)
+    req_text = create_full_text(
+        video.path, video.series, video.part, video.text, video.outro)
+
+    console.log(f"{msg.OK}Text converted successfully")
+    logger.info('Text converted successfully')
+    console.log(req_text)
+    mp3 = await tts(req_text, voice=args.tts, random_voice=args.random_voice, args=args)
+    audio = await decode_audio(mp3)
+
+    console.log(
+        f"{msg.OK}Text2Speech audio generated successfully!")
+    logger.info('Text2Speech audio generated successfully!')
+    return mp3, audio
+
+async def process_video(mp3: bytes, audio: np.ndarray, srt_filename: Path, args, backgrounds: asyncio.Lock, encoders: asyncio.Semaphore) -> Path:
+    """
+    Create the final video of a transcribed clip.
+
+    Videos are encoded concurrently, each on its own background.
+
+    Args:
+        mp3 (bytes): The speech audio, in mp3 format.
+        audio (np.ndarray): The 16kHz samples of the speech audio.
+        srt_filename (Path): The SRT file of the speech audio.
+        args (argparse.Namespace): The command-line arguments.
+        backgrounds (asyncio.Lock): Serializes the pre-processing of background videos.
+        encoders (asyncio.Semaphore): Limits the number of concurrent ffmpeg encodes.
+
+    Returns:
+        Path: The path to the output video file.
+    """
+    # Background video with srt and duration
+    async with backgrounds:
+        background_mp4 = await prepare_mezzanine(random_background(), verbose=args.verbose)
+    file_info = get_info(background_mp4, verbose=args.verbose)
+    async with encoders:
+        final_video = await prepare_background(
+            background_mp4, mp3=mp3, mp3_duration=len(audio) / SAMPLING_RATE, filename_srt=srt_filename, duration=int(file_info.get('duration')), verbose=args.verbose)
+    console.log(
+        f"{msg.OK}MP4 video saved successfully!\nPath: {final_video}")
+    logger.info(f'MP4 video saved successfully!\nPath: {final_video}')
+    return final_video
+
 def download_video(url: str, folder: str = 'background'):
     """
     Downloads a video from the given URL and saves it to the specified folder.
@@ -187,15 +316,18 @@ def download_video(url: str, folder: str = 'background'):
         url (str): The URL of the video to download.
         folder (str, optional): The name of the folder to save the video in. Defaults to 'background'.
     """
-    if not os.path.isdir(folder):
-        os.mkdir(f"{HOME}{os.sep}{folder}")
-    with KeepDir() as keep_dir:
-        keep_dir.chdir(folder)
-        with subprocess.Popen(['yt-dlp', '--restrict-filenames', '--merge-output-format', 'mp4', url]) as process:
-            pass
-        console.log(
-            f"{msg.OK}Background video downloaded successfully")
-        logger.info('Background video downloaded successfully')
+    folder_path = HOME / folder
+    folder_path.mkdir(parents=True, exist_ok=True)
+    try:
+        subprocess.run(['yt-dlp', '--restrict-filenames', '--merge-output-format', 'mp4', url], cwd=folder_path,
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    except subprocess.CalledProcessError as e:
+        console.log(f"{msg.ERROR}{e.stderr}")
+        logger.exception(e.stderr)
+        sys.exit(1)
+    console.log(
+        f"{msg.OK}Background video downloaded successfully")
+    logger.info('Background video downloaded successfully')
     return
 
 def random_background(folder_path: str = "background") -> str:
@@ -208,12 +340,17 @@ def random_background(folder_path: str = "background") -> str:
     Returns:
         str: The filename of a randomly selected file in the folder.
     """
-    if not os.path.isdir(folder_path):
-        os.mkdir(folder_path)
-    with KeepDir() as keep_dir:
-        keep_dir.chdir(f"{HOME}{os.sep}{folder_path}")
-        files = os.listdir(".")
-        random_file = random.choice(files)
+    folder = HOME / folder_path
+    folder.mkdir(parents=True, exist_ok=True)
+    # Reservoir sampling: a single pass over the folder without building a list
+    random_file = None
+    with os.scandir(folder) as entries:
+        files = (entry for entry in entries if entry.is_file())
+        for i, entry in enumerate(files):
+            if random.randrange(i + 1) == 0:
+                random_file = entry.name
+    if random_file is None:
+        raise FileNotFoundError(f"No background video found in {folder}")
     return random_file
 
 
@@ -229,131 +366,531 @@ def get_info(filename: str, verbose: bool = False):
         dict: A dictionary containing information about the video file, including width, height, bit rate, and duration.
     """
     try:
-        with KeepDir() as keep_dir:
-            keep_dir.chdir(f"{HOME}{os.sep}background")
-
-            # Get video duration
-            result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', filename], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            duration = float(result.stdout)
-
-            try:
-                # Get video width and height
-                result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'stream=width,height', '-of', 'default=noprint_wrappers=1:nokey=1', filename], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                width_height = result.stdout.decode('utf-8').strip().split('\n')
-                width, height = width_height[0], width_height[1]
-
-            except IndexError: # audio stream
-                result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'stream=bit_rate', '-of', 'default=noprint_wrappers=1:nokey=1', filename], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                bit_rate = result.stdout.decode('utf-8').strip()
-                return {'bit_rate': bit_rate, 'duration': duration}
-
-            return {'width': int(width), 'height': int(height), 'duration': duration}
-    except ffmpeg.Error as e:
+        # Relative filenames are looked up in the background folder
+        filename = HOME / 'background' / filename
+        return dict(probe(filename, filename.stat().st_mtime))
+    except subprocess.CalledProcessError as e:
         console.log(f"{msg.ERROR}{e.stderr}")
         logger.exception(e.stderr)
         sys.exit(1)
 
-def prepare_background(background_mp4: str, filename_mp3: str, filename_srt: str, duration: int, verbose: bool = False) -> str:
+
+@functools.lru_cache(maxsize=128)
+def probe(filename: Path, mtime: float) -> dict:
+    """
+    Run ffprobe once on a file and extract its duration and video size (or audio bit rate).
+
+    Results are cached; `mtime` is part of the key so that modified files are probed again.
+
+    Args:
+        filename (Path): The absolute path to the media file.
+        mtime (float): The modification time of the file.
+
+    Returns:
+        dict: The width, height and duration of a video file, or the bit rate and duration of an audio file.
+    """
+    result = subprocess.run(['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', str(filename)],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
+    info = orjson.loads(result.stdout)
+    duration = float(info['format']['duration'])
+
+    for stream in info['streams']:
+        if stream.get('codec_type') == 'video' and not stream.get('disposition', {}).get('attached_pic'):
+            return {'width': int(stream['width']), 'height': int(stream['height']), 'duration': duration}
+
+    # audio stream
+    bit_rate = info['streams'][0].get('bit_rate') if info['streams'] else info['format'].get('bit_rate')
+    return {'bit_rate': bit_rate, 'duration': duration}
+
+# Video encoder arguments, from fastest to slowest
+ENCODER_ARGS = {
+    "h264_nvenc": ["-c:v", "h264_nvenc", "-preset", "p4", "-tune", "hq", "-rc", "vbr", "-b:v", "{bitrate}", "-maxrate", "{maxrate}"],
+    "h264_amf": ["-c:v", "h264_amf", "-quality", "speed", "-rc", "vbr_peak", "-b:v", "{bitrate}", "-maxrate", "{maxrate}"],
+    "h264_qsv": ["-c:v", "h264_qsv", "-preset", "faster", "-b:v", "{bitrate}", "-maxrate", "{maxrate}"],
+    "libx264": ["-c:v", "libx264", "-preset", "5", "-b:v", "{bitrate}"],
+}
+
+# Background pre-processing: crop to 9:16, upscale and blur
+BACKGROUND_FILTER = "crop=ih/16*9:ih, scale=w=1080:h=1920:flags=bicubic, gblur=sigma=2"
+
+# Hardware decoding arguments for the background video. The decoded frames go through CPU filters,
+# so only decoders that hand them back in system memory fit here (QSV decoding needs a full QSV pipeline)
+HWACCEL_ARGS = {
+    "h264_nvenc": ["-hwaccel", "cuda"],
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoder() -> str:
+    """
+    Returns the fastest H.264 encoder that works on this machine.
+
+    Hardware encoders are only picked if ffmpeg lists them and a one-frame test encode with
+    the options of `encoder_args` succeeds; NVENC additionally requires PyTorch to find a
+    CUDA GPU. Falls back to libx264.
+
+    Returns:
+        str: The name of the ffmpeg video encoder.
+    """
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    except FileNotFoundError:
+        return "libx264"
+
+    for encoder in ENCODER_ARGS:
+        if encoder == "libx264":
+            break
+        if encoder == "h264_nvenc" and not torch.cuda.is_available():
+            continue
+        if not re.search(rf"\b{encoder}\b", result.stdout):
+            continue
+        # Test with the same options as the real encode, not just the encoder name
+        test = subprocess.run(['ffmpeg', '-hide_banner', '-v', 'error', '-f', 'lavfi', '-i', 'color=size=256x256:duration=0.1',
+                               '-frames:v', '1', *encoder_args(encoder), '-f', 'null', '-'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if test.returncode == 0:
+            return encoder
+    return "libx264"
+
+
+def encoder_args(encoder: str, bitrate: str = "5M", maxrate: str = "7M") -> list:
+    """
+    Returns the ffmpeg output arguments of a video encoder.
+
+    Args:
+        encoder (str): The name of the encoder, as returned by `get_encoder`.
+        bitrate (str, optional): The target video bit rate. Defaults to "5M".
+        maxrate (str, optional): The maximum video bit rate, ignored by libx264. Defaults to "7M".
+
+    Returns:
+        list: The ffmpeg arguments.
+    """
+    return [arg.format(bitrate=bitrate, maxrate=maxrate) for arg in ENCODER_ARGS[encoder]]
+
+
+async def run_ffmpeg(args: list, cwd: Path = None, input: bytes = None, capture_stdout: bool = False) -> bytes:
+    """
+    Run an ffmpeg command and wait for it to finish.
+
+    Args:
+        args (list): The ffmpeg command line.
+        cwd (Path, optional): The working directory of the command. Defaults to None.
+        input (bytes, optional): The data to send to ffmpeg's stdin (pipe:0). Defaults to None.
+        capture_stdout (bool, optional): Whether to return what ffmpeg writes to stdout (pipe:1). Defaults to False.
+
+    Returns:
+        bytes: The stdout of ffmpeg, or None if `capture_stdout` is False.
+
+    Raises:
+        subprocess.CalledProcessError: If ffmpeg exits with an error.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *args, cwd=cwd, stdin=subprocess.DEVNULL if input is None else subprocess.PIPE,
+        stdout=subprocess.PIPE if capture_stdout else subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stdout, stderr = await process.communicate(input)
+    if process.returncode != 0:
+        stderr = stderr.decode('utf-8', errors='replace')
+        console.log(f"{msg.ERROR}{stderr}")
+        logger.error(stderr)
+        raise subprocess.CalledProcessError(process.returncode, args, stderr=stderr)
+    return stdout
+
+
+# Sampling rate expected by Whisper
+SAMPLING_RATE = 16000
+
+
+async def decode_audio(mp3: bytes) -> np.ndarray:
+    """
+    Decode mp3 audio in memory into the mono 16kHz float32 samples expected by Whisper.
+
+    Args:
+        mp3 (bytes): The mp3 audio.
+
+    Returns:
+        np.ndarray: The audio samples.
+    """
+    pcm = await run_ffmpeg(["ffmpeg", "-f", "mp3", "-i", "pipe:0", "-f", "f32le", "-ac", "1", "-ar", str(SAMPLING_RATE), "pipe:1"],
+                           input=mp3, capture_stdout=True)
+    return np.frombuffer(pcm, dtype=np.float32)
+
+
+async def prepare_mezzanine(background_mp4: str, verbose: bool = False) -> Path:
+    """
+    Crop, scale and blur a background video once and cache the result.
+
+    The cached file is reused by every video cut from the same background, so that
+    only the subtitles have to be rendered per video. It is rebuilt whenever the
+    background file is newer than the cache.
+
+    Args:
+        background_mp4 (str): The filename of the background video in the background folder.
+        verbose (bool, optional): Whether to print verbose output. Defaults to False.
+
+    Returns:
+        Path: The absolute path to the pre-processed background video.
+    """
+    background_path = HOME / 'background' / background_mp4
+    (HOME / 'cache').mkdir(exist_ok=True)
+    mezzanine = HOME / 'cache' / f"{background_path.stem}_1080x1920.mp4"
+    partial = mezzanine.with_name(f"{mezzanine.name}.part")
+
+    if mezzanine.is_file() and mezzanine.stat().st_mtime >= background_path.stat().st_mtime:
+        return mezzanine
+
+    encoder = get_encoder()
+    args = [
+        "ffmpeg",
+        *HWACCEL_ARGS.get(encoder, []),
+        "-i", str(background_path),
+        "-an",
+        "-filter:v", BACKGROUND_FILTER,
+        *encoder_args(encoder, bitrate="15M", maxrate="20M"),
+        "-f", "mp4", str(partial), "-y",
+        "-threads", f"{multiprocessing.cpu_count()//2}"]
+
+    if verbose:
+        rich_print('[i] FFMPEG Command:\n'+' '.join(args)+'\n', style='yellow')
+
+    await run_ffmpeg(args)
+    partial.replace(mezzanine)
+
+    console.log(f"{msg.OK}Background video pre-processed successfully")
+    logger.info('Background video pre-processed successfully')
+    return mezzanine
+
+
+async def prepare_background(background_mp4: Path, mp3: bytes, mp3_duration: float, filename_srt: Path, duration: int, verbose: bool = False) -> Path:
     """
     Prepare a background video with an audio file and a subtitle file.
 
     Args:
-        background_mp4 (str): The path to the background video file.
-        filename_mp3 (str): The path to the audio file to be merged with the background video.
-        filename_srt (str): The path to the subtitle file to be added to the background video.
+        background_mp4 (Path): The path to the pre-processed background video file.
+        mp3 (bytes): The mp3 audio to be merged with the background video, piped to ffmpeg.
+        mp3_duration (float): The duration of the audio in seconds.
+        filename_srt (Path): The path to the subtitle file to be added to the background video.
         duration (int): The duration of the output video in seconds.
         verbose (bool, optional): Whether to print verbose output. Defaults to False.
 
     Returns:
-        str: The path to the output video file.
+        Path: The path to the output video file.
     """
-    # Get length of MP3 file to be merged with
-    audio_info = get_info(filename_mp3)
-
     # Get starting time:
-    audio_duration = int(round(audio_info.get('duration'), 0))
-    ss = random.randint(0, (duration-audio_duration))
-    audio_duration = convert_time(audio_info.get('duration'))
-    if ss < 0:
-        ss = 0
+    audio_duration = int(round(mp3_duration, 0))
+    ss = random.randint(0, max(duration-audio_duration, 0))
+    audio_duration = convert_time(mp3_duration)
 
-    srt_filename = filename_srt.split('\\')[-1]
-    srt_path = Path(srt_filename).parent.absolute()
+    # ffmpeg runs in the subtitles folder, so the filter only needs the file name
+    srt_filename = Path(filename_srt).name
+    srt_path = Path(filename_srt).parent.absolute()
 
     # Create output directory
-    if not os.path.isdir(f"{HOME}{os.sep}output"):
-        os.mkdir(f"{HOME}{os.sep}output")
-    outfile = f"{HOME}{os.sep}output{os.sep}output_{ss}.mp4"
+    (HOME / 'output').mkdir(exist_ok=True)
+    # Named after the subtitles ({series}_{part}) so that concurrent encodes never share a file
+    outfile = HOME / 'output' / f"{Path(filename_srt).stem}_{ss}.mp4"
 
-    with KeepDir() as keep_dir:
-        keep_dir.chdir(f"{HOME}{os.sep}background")
-        mp4_absolute_path = os.path.abspath(background_mp4)
+    mp4_absolute_path = Path(background_mp4).absolute()
 
     if verbose:
         rich_print(
-            f"{filename_srt = }\n{mp4_absolute_path = }\n{filename_mp3 = }\n", style='bold green')   #
+            f"{filename_srt = }\n{mp4_absolute_path = }\n{mp3_duration = }\n", style='bold green')   #
         # 'Alignment=9,BorderStyle=3,Outline=5,Shadow=3,Fontsize=15,MarginL=5,MarginV=25,FontName=Lexend Bold,ShadowX=-7.1,ShadowY=7.1,ShadowColour=&HFF000000,Blur=141'Outline=5
+    encoder = get_encoder()
     args = [
         "ffmpeg", 
+        *HWACCEL_ARGS.get(encoder, []),
         "-ss", str(ss), 
         "-t", str(audio_duration), 
-        "-i", mp4_absolute_path, 
-        "-i", filename_mp3, 
+        "-i", str(mp4_absolute_path), 
+        "-f", "mp3", "-i", "pipe:0", 
         "-map", "0:v", 
         "-map", "1:a", 
         "-filter:v", 
-        f"crop=ih/16*9:ih, scale=w=1080:h=1920:flags=bicubic, gblur=sigma=2, subtitles={srt_filename}:force_style=',Alignment=8,BorderStyle=7,Outline=3,Shadow=5,Blur=15,Fontsize=15,MarginL=45,MarginR=55,FontName=Lexend Bold'", 
-        "-c:v", "libx264", "-preset", "5", 
-        "-b:v", "5M", 
+        f"subtitles={srt_filename}:force_style=',Alignment=8,BorderStyle=7,Outline=3,Shadow=5,Blur=15,Fontsize=15,MarginL=45,MarginR=55,FontName=Lexend Bold'", 
+        *encoder_args(encoder),
         "-c:a", "aac", "-ac", "1", 
         "-b:a", "96K", 
-        f"{outfile}", "-y", 
+        str(outfile), "-y", 
         "-threads", f"{multiprocessing.cpu_count()//2}"]
 
     if verbose:
         rich_print('[i] FFMPEG Command:\n'+' '.join(args)+'\n', style='yellow')
 
-    with KeepDir() as keep_dir:
-        keep_dir.chdir(srt_path)
-        with subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE) as process:
-            pass
+    await run_ffmpeg(args, cwd=srt_path, input=mp3)
 
     return outfile
 
-def srt_create(model, path: str, series: str, part: int, text: str, filename: str) -> bool:
+# Models available in whisper_trt
+TRT_MODELS = ("tiny.en", "base.en", "small.en")
+
+# Seconds of audio whisper_trt transcribes per call
+TRT_WINDOW = 30
+
+
+def load_model(model: str, backend: str = "faster-whisper", batch_size: int = 8):
+    """
+    Load a Whisper model with the given inference backend.
+
+    Args:
+        model (str): The name of the Whisper model, for example "small.en".
+        backend (str, optional): One of "faster-whisper" (CTranslate2), "trt" (TensorRT) or "hf" (Transformers). Defaults to "faster-whisper".
+        batch_size (int, optional): The number of 30s audio chunks decoded together by faster-whisper, across clips. Defaults to 8.
+
+    Returns:
+        Callable[[List[np.ndarray]], List[List[Tuple[float, float, str]]]]: A function transcribing clips of 16kHz
+        audio samples into the (start, end, word) timings of each clip.
+    """
+    if backend == "trt":
+        from whisper_trt import load_trt_model
+
+        # The TensorRT engine is built on the first run (a couple of minutes) and loaded from the cache afterwards,
+        # whisper_trt only creates the cache folder itself when no path is given
+        cache = Path.home() / ".cache" / "whisper_trt"
+        cache.mkdir(parents=True, exist_ok=True)
+        trt_model = load_trt_model(model, path=str(cache / f"{model}.pth"))
+
+        def transcribe_clip(audio):
+            # whisper_trt only decodes the first 30s of its input and returns text without timestamps
+            words = []
+            window = TRT_WINDOW * SAMPLING_RATE
+            for offset in range(0, len(audio), window):
+                chunk = audio[offset:offset + window]
+                start = offset / SAMPLING_RATE
+                words.extend(spread_words(trt_model.transcribe(chunk)['text'],
+                                          start, start + len(chunk) / SAMPLING_RATE))
+            return words
+
+        def transcribe(audios):
+            # whisper_trt has no batched decoding
+            return [transcribe_clip(audio) for audio in audios]
+        return transcribe
+
+    if backend == "hf":
+        from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor, pipeline
+        from transformers.utils import is_flash_attn_2_available
+
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        torch_dtype = torch.float16 if device == "cuda" else torch.float32
+        model_id = f"openai/whisper-{'large-v3' if model == 'large' else model}"
+        # Without flash-attn, transformers picks the best attention supported by the installed torch
+        flash_attn = is_flash_attn_2_available()
+        attn_kwargs = {"attn_implementation": "flash_attention_2"} if flash_attn else {}
+        hf_model = AutoModelForSpeechSeq2Seq.from_pretrained(
+            model_id, torch_dtype=torch_dtype, **attn_kwargs).to(device)
+        processor = AutoProcessor.from_pretrained(model_id)
+        pipe = pipeline("automatic-speech-recognition", model=hf_model, tokenizer=processor.tokenizer,
+                        feature_extractor=processor.feature_extractor, chunk_length_s=30, batch_size=24,
+                        torch_dtype=torch_dtype, device=device)
+
+        def transcribe(audios):
+            # The pipeline batches the 30s chunks of all the clips together. Word timestamps come from the
+            # cross-attention weights, which flash attention 2 does not return, so with flash-attn the words
+            # are spread over the timestamps of their segment instead
+            inputs = [{"raw": audio, "sampling_rate": SAMPLING_RATE} for audio in audios]
+            if not flash_attn:
+                results = pipe(inputs, return_timestamps="word")
+                # The last chunk may have no end timestamp
+                return [[(chunk['timestamp'][0], chunk['timestamp'][1] or chunk['timestamp'][0], chunk['text'])
+                         for chunk in result['chunks']] for result in results]
+            results = pipe(inputs, return_timestamps=True)
+            return [[word for chunk in result['chunks']
+                     for word in spread_words(chunk['text'], chunk['timestamp'][0],
+                                              chunk['timestamp'][1] or len(audio) / SAMPLING_RATE)]
+                    for audio, result in zip(audios, results)]
+        return transcribe
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    compute_type = "int8_float16" if device == "cuda" else "int8"
+    whisper_model = WhisperModel(model, device=device, compute_type=compute_type)
+    batched_model = BatchedInferencePipeline(model=whisper_model)
+    # Same voice activity detection as BatchedInferencePipeline, splitting speech into chunks of at most 30s
+    vad_options = VadOptions(max_speech_duration_s=whisper_model.feature_extractor.chunk_length,
+                             min_silence_duration_ms=160)
+
+    def transcribe(audios):
+        # BatchedInferencePipeline only batches the chunks of a single file, and a TTS clip is usually a
+        # single chunk. So the clips are concatenated and their speech chunks passed as clip timestamps,
+        # which lets chunks of different clips be decoded in the same batch
+        clips = []
+        chunk_clip = {}
+        offsets = []
+        offset = 0
+        for i, audio in enumerate(audios):
+            offsets.append(offset / SAMPLING_RATE)
+            for chunk in merge_segments(get_speech_timestamps(audio, vad_options), vad_options):
+                start = offset + chunk["start"]
+                clips.append({"start": start, "end": offset + chunk["end"]})
+                # Each segment reports the start of its chunk, in frames, as seek
+                chunk_clip[int(start / SAMPLING_RATE * whisper_model.frames_per_second)] = i
+            offset += len(audio)
+
+        words = [[] for _ in audios]
+        if not clips:
+            return words
+        segments, info = batched_model.transcribe(
+            np.concatenate(audios), clip_timestamps=clips, word_timestamps=True, beam_size=5, batch_size=batch_size)
+        for segment in segments:
+            i = chunk_clip[segment.seek]
+            words[i].extend((word.start - offsets[i], word.end - offsets[i], word.word) for word in segment.words)
+        return words
+    return transcribe
+
+
+def spread_words(text: str, start: float, end: float):
+    """
+    Time the words of an untimed transcript by spreading them over a time window.
+
+    Each word gets a share of the window proportional to its length, so the subtitles
+    follow the speech only approximately.
+
+    Args:
+        text (str): The transcript.
+        start (float): The start of the window in seconds.
+        end (float): The end of the window in seconds.
+
+    Returns:
+        List[Tuple[float, float, str]]: The (start, end, word) timings.
+    """
+    words = text.split()
+    total = sum(len(word) for word in words)
+    span = end - start
+    timings = []
+    for word in words:
+        duration = span * len(word) / total
+        timings.append((start, start + duration, f" {word}"))
+        start += duration
+    return timings
+
+
+# Whisper model of the transcription worker process
+_worker_model = None
+
+
+def init_transcriber(model: str, backend: str) -> None:
+    """
+    Load the Whisper model in the transcription worker process.
+
+    Args:
+        model (str): The name of the Whisper model.
+        backend (str): The inference backend, see `load_model`.
+    """
+    global _worker_model
+    if backend in ("trt", "hf") and torch.cuda.is_available():
+        # Only the PyTorch based backends use these: cuDNN autotuning, TF32 matmuls on Ampere and newer,
+        # and a dedicated stream for the model (ffmpeg uses its own device context and never shares it)
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.cuda.set_stream(torch.cuda.Stream())
+    _worker_model = load_model(model, backend=backend)
+
+
+def transcriber_ready() -> bool:
+    """
+    Returns whether the transcription worker process has loaded its model.
+    """
+    return _worker_model is not None
+
+
+def transcribe_srts(clips: List[Tuple[str, str, int, str, np.ndarray]]) -> List[Path]:
+    """
+    Transcribe all clips in one batch with the model of the transcription worker process,
+    and write their SRT files with `srt_create`.
+
+    Args:
+        clips (List[Tuple[str, str, int, str, np.ndarray]]): The path, series, part, text and 16kHz audio samples of each clip.
+
+    Returns:
+        List[Path]: The paths to the SRT files.
+    """
+    with torch.inference_mode():
+        words = _worker_model([audio for *_, audio in clips])
+    return [srt_create(clip_words, path, series, part, text)
+            for (path, series, part, text, _), clip_words in zip(clips, words)]
+
+
+def srt_create(words, path: str, series: str, part: int, text: str) -> Path:
     """
-    Create an SRT file for a given video file using the specified model.
+    Create an SRT file for a given video file from its transcription.
 
     Args:
-        model: The model to use for transcription.
+        words (Iterable[Tuple[float, float, str]]): The (start, end, word) timings, as returned by `load_model`.
         path (str): The path to the directory where the SRT file should be saved.
         series (str): The name of the series the video belongs to.
         part (int): The part number of the video.
         text (str): The text to transcribe.
-        filename (str): The name of the video file.
 
     Returns:
-        bool: True if the SRT file was created successfully, False otherwise.
+        Path: The path to the SRT file.
     """
     series = series.replace(' ', '_')
-    srt_path = f"{path}{os.sep}{series}{os.sep}"
+    srt_filename = Path(path) / series / f"{series}_{part}.srt"
 
-    word_options = {
-        "highlight_words": True,
-        "max_line_count": 1,
-        "max_line_width": 40,
-        "preserve_segments": False,
-    }
+    write_srt(words, srt_filename)
 
-    transcribe = model.transcribe(
-        filename, task="transcribe", word_timestamps=True, fp16=torch.cuda.is_available())
-    vtt_writer = whisper.utils.get_writer(
-        output_format="srt", output_dir=srt_path)
-    vtt_writer(transcribe, filename, word_options)
+    return srt_filename
 
-    srt_filename = f"{srt_path}{series}_{part}.srt"
 
-    return srt_filename
+def iterate_subtitles(words, max_line_width: int = 40):
+    """
+    Groups timed words into single-line subtitles.
+
+    A new line is started when the current one would exceed `max_line_width`
+    characters or when there is a pause longer than three seconds.
+
+    Args:
+        words (Iterable[Tuple[float, float, str]]): The (start, end, word) timings.
+        max_line_width (int, optional): The maximum number of characters per line. Defaults to 40.
+
+    Yields:
+        List[Tuple[float, float, str]]: The word timings of each subtitle line.
+    """
+    line = []
+    line_len = 0
+    last = None
+    for start, end, word in words:
+        long_pause = last is not None and start - last > 3.0
+        if line_len > 0 and line_len + len(word) <= max_line_width and not long_pause:
+            line_len += len(word)
+        else:
+            word = word.strip()
+            if line:
+                yield line
+                line = []
+            line_len = len(word)
+        line.append((start, end, word))
+        last = start
+    if line:
+        yield line
+
+
+def write_srt(words, srt_filename: Path) -> None:
+    """
+    Writes timed words to an SRT file, underlining each word while it is spoken.
+
+    Args:
+        words (Iterable[Tuple[float, float, str]]): The (start, end, word) timings.
+        srt_filename (Path): The path of the SRT file to write.
+    """
+    with open(srt_filename, 'w', encoding='utf-8') as srt:
+        index = 1
+
+        def write_cue(start, end, text):
+            nonlocal index
+            srt.write(
+                f"{index}\n{convert_time(start).replace('.', ',')} --> {convert_time(end).replace('.', ',')}\n{text.strip().replace('-->', '->')}\n\n")
+            index += 1
+
+        for line in iterate_subtitles(words):
+            all_words = [word for _, _, word in line]
+            last = line[0][0]
+            for i, (start, end, _) in enumerate(line):
+                if last < start:
+                    write_cue(last, start, "".join(all_words))
+                write_cue(start, end, "".join(
+                    re.sub(r"^(\s*)(.*)$", r"\1<u>\2</u>", word) if j == i else word
+                    for j, word in enumerate(all_words)))
+                last = end
 
 
 def convert_time(time_in_seconds):
@@ -366,59 +903,117 @@ def convert_time(time_in_seconds):
     Returns:
         str: The time in the format "hh:mm:ss.mmm".
     """
-    hours = int(time_in_seconds // 3600)
-    minutes = int((time_in_seconds % 3600) // 60)
-    seconds = int(time_in_seconds % 60)
-    milliseconds = int((time_in_seconds - int(time_in_seconds)) * 1000)
+    total_ms = round(time_in_seconds * 1000)
+    hours, rem = divmod(total_ms, 3600_000)
+    minutes, rem = divmod(rem, 60_000)
+    seconds, milliseconds = divmod(rem, 1000)
     return f"{hours:02d}:{minutes:02d}:{seconds:02d}.{milliseconds:03d}"
 
+# Splits a filename into its text and number parts for alphanumeric sorting
+_SPLIT_RE = re.compile(r'(\d+)')
+
+
+def alphanum_key(name: str) -> list:
+    """
+    Sort key ordering names with numbers naturally, e.g. "2.mp4" before "10.mp4".
+
+    Args:
+        name (str): The name to sort.
+
+    Returns:
+        list: The text parts in lower case and the number parts as integers.
+    """
+    return [int(part) if part.isdecimal() else part.lower() for part in _SPLIT_RE.split(name)]
+
+# Container formats that batch_create joins with ffmpeg instead of a byte copy
+CONCAT_FORMATS = {'.mp4', '.mkv', '.mov', '.webm', '.m4a'}
+
+
 def batch_create(filename: str) -> None:
     """
     Batch creates a file by concatenating all files in the './batch/' directory in alphanumeric order.
 
+    Media containers (see `CONCAT_FORMATS`) are joined with ffmpeg's concat demuxer without
+    re-encoding, any other file is a plain byte concatenation.
+
     Args:
     - filename (str): the name of the file to be created.
 
     Returns:
     - None
     """
-    with open(filename, 'wb') as out:
-        def sorted_alphanumeric(data):
-            def convert(text): return int(
-                text) if text.isdigit() else text.lower()
-            def alphanum_key(key): return [convert(c)
-                                           for c in re.split('([0-9]+)', key)]
-            return sorted(data, key=alphanum_key)
-
-        for item in sorted_alphanumeric(os.listdir('./batch/')):
-            filestuff = open('./batch/' + item, 'rb').read()
-            out.write(filestuff)
+    with os.scandir(Path('batch').absolute()) as entries:
+        items = [entry.path for entry in sorted(entries, key=lambda entry: alphanum_key(entry.name))]
+
+    if Path(filename).suffix.lower() not in CONCAT_FORMATS:
+        with open(filename, 'wb') as out:
+            for item in items:
+                with open(item, 'rb') as src:
+                    shutil.copyfileobj(src, out, length=1024*1024)
+        return
+
+    # Concat list, quotes in the paths are escaped as '\''
+    list_file = Path(f"{filename}.txt")
+    with open(list_file, 'w', encoding='utf-8') as f:
+        for item in items:
+            escaped = str(item).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    try:
+        subprocess.run(['ffmpeg', '-f', 'concat', '-safe', '0', '-i', str(list_file), '-c', 'copy', str(filename), '-y'],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    except subprocess.CalledProcessError as e:
+        console.log(f"{msg.ERROR}{e.stderr}")
+        logger.exception(e.stderr)
+        sys.exit(1)
+    finally:
+        list_file.unlink()
 
-def create_full_text(path: str = '', series: str = '', part: int = 1, text: str = '', outro: str = '') -> Tuple[str, str]:
+def create_full_text(path: str = '', series: str = '', part: int = 1, text: str = '', outro: str = '') -> str:
     """
-    Creates full text and filename for a given series, part, text and outro.
+    Creates the full text for a given series, part, text and outro, and the series folder for its subtitles.
 
     Args:
-        path (str): The path where the file will be saved.
+        path (str): The path where the series folder will be created.
         series (str): The name of the series.
         part (int): The part number of the series.
         text (str): The main text of the series.
         outro (str): The outro of the series.
 
     Returns:
-        Tuple[str, str]: A tuple containing the full text and filename.
+        str: The full text to be converted to speech.
     """
     req_text = f"{series} Part {part}.\n{text}\n{outro}"
     series = series.replace(' ', '_')
-    filename = f"{path}{os.sep}{series}{os.sep}{series}_{part}.mp3"
-    
+    folder = Path(path) / series
+
     # create directory if not exist
-    if not os.path.isdir(f"{path}{os.sep}{series}"):
-        os.mkdir(f"{path}{os.sep}{series}")
-    return req_text, filename
+    folder.mkdir(parents=True, exist_ok=True)
+    return req_text
+
+
+# Edge TTS voice list, fetched on first use
+_voices = None
+_voices_lock = None
 
 
-async def tts(final_text: str, voice: str = "en-US-ChristopherNeural", random_voice: bool = False, stdout: bool = False, outfile: str = "tts.mp3", args=None) -> bool:
+async def get_voices() -> edge_tts.VoicesManager:
+    """
+    Returns the Edge TTS voice list, fetching it only once per run.
+
+    Returns:
+        edge_tts.VoicesManager: The voices available for Text-to-Speech.
+    """
+    global _voices, _voices_lock
+    # Created lazily so that the lock belongs to the running event loop
+    if _voices_lock is None:
+        _voices_lock = asyncio.Lock()
+    async with _voices_lock:
+        if _voices is None:
+            _voices = await edge_tts.VoicesManager.create()
+    return _voices
+
+
+async def tts(final_text: str, voice: str = "en-US-ChristopherNeural", random_voice: bool = False, outfile: str = None, args=None) -> bytes:
     """
     Converts text to speech using Microsoft Edge Text-to-Speech API.
 
@@ -426,38 +1021,35 @@ async def tts(final_text: str, voice: str = "en-US-ChristopherNeural", random_vo
         final_text (str): The text to be converted to speech.
         voice (str, optional): The name of the voice to use. Defaults to "en-US-ChristopherNeural".
         random_voice (bool, optional): Whether to choose a random voice based on the gender and language specified in `args`. Defaults to False.
-        stdout (bool, optional): Whether to output the speech audio to stdout. Defaults to False.
-        outfile (str, optional): The name of the output file. Defaults to "tts.mp3".
+        outfile (str, optional): The name of an mp3 file to also save the speech to. Defaults to None.
         args (object, optional): An object containing the gender and language to use when selecting a random voice. Defaults to None.
 
     Returns:
-        bool: True if the text was successfully converted to speech and saved to a file, False otherwise.
+        bytes: The speech audio, in mp3 format.
     """
-    voices = await edge_tts.VoicesManager.create()
     if random_voice:
+        voices = await get_voices()
         voices = voices.find(Gender=args.gender, Locale=args.language)
         voice = random.choice(voices)["Name"]
     communicate = edge_tts.Communicate(final_text, voice)
-    if not stdout:
-        await communicate.save(outfile)
-    return True
+    audio = bytearray()
+    async for chunk in communicate.stream():
+        if chunk["type"] == "audio":
+            audio.extend(chunk["data"])
+    if outfile:
+        with open(outfile, 'wb') as f:
+            f.write(audio)
+    return bytes(audio)
 
 if __name__ == "__main__":
 
-    if platform.system() == 'Windows':
-        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-
-    loop = asyncio.get_event_loop()
+    result = False
 
     try:
-        loop.run_until_complete(main())
+        result = asyncio.run(main())
 
     except Exception as e:
-        loop.close()
         console.log(f"{msg.ERROR}{e}")
         logger.exception(e)
 
-    finally:
-        loop.close()
-
-    sys.exit(1)
+    sys.exit(0 if result else 1)